@@ -1,12 +1,15 @@
-from .utils.general import db_init, get_unambiguous_username, parse_fsas, parse_username
+from .utils.fsa_centroids import FsaCentroidIndex
+from .utils.general import db_init, get_unambiguous_username, parse_fsas_with_radius, parse_schedule_time, parse_username
 import argparse
 import asyncio
+import datetime
 import discord
 from discord.ext import commands, tasks
 import logging
 import pathlib
 import psycopg2
 from psycopg2 import extras
+import re
 import sys
 import yaml
 
@@ -27,13 +30,19 @@ DISCORD_MESSAGE_LENGTH_HIGH_WATERMARK = DISCORD_MESSAGE_LENGTH_LIMIT - 500
 MAX_FSAS_TO_PING_AT_ONCE = 100
 # NOTE: 100 is the library limit
 MAX_USERS_TO_QUERY_AT_ONCE = 100
+# Scheduled pings are resolved and rendered this long before they're due, then kept up to date until they're sent
+SCHEDULE_PREPARE_LEAD_TIME = datetime.timedelta(minutes=5)
+# How often (in seconds) to look for scheduled pings coming due and to check prepared pings for registration changes
+SCHEDULE_POLL_INTERVAL = 15
+# Scheduled pings that are overdue by more than this (ex: the bot was down) are dropped instead of sent
+SCHEDULE_MAX_LATENESS = SCHEDULE_PREPARE_LEAD_TIME
 
 
-def add_user_to_fsas(user, raw_fsas, conn):
+def add_user_to_fsas(user, raw_fsas, conn, fsa_index):
     # Parse FSAs
     if len(raw_fsas) < 1:
         raise ValueError("Please provide an area code (ex: K1P).")
-    fsas = parse_fsas(raw_fsas)
+    fsas = parse_fsas_with_radius(raw_fsas, fsa_index)
 
     # Assemble rows
     user_id = str(user.id)
@@ -48,11 +57,11 @@ def add_user_to_fsas(user, raw_fsas, conn):
             psycopg2.extras.execute_values(cur, "INSERT INTO ping_reg VALUES %s ON CONFLICT DO NOTHING", rows, template="(%(username)s, %(user_id)s, %(fsa)s)")
 
 
-def del_user_from_fsas(user_id, raw_fsas, conn):
+def del_user_from_fsas(user_id, raw_fsas, conn, fsa_index):
     # Parse FSAs
     if len(raw_fsas) < 1:
         raise ValueError("Please provide an area code (ex: K1P).")
-    fsas = parse_fsas(raw_fsas)
+    fsas = parse_fsas_with_radius(raw_fsas, fsa_index)
 
     # Delete rows
     with conn:
@@ -90,6 +99,143 @@ async def list_fsas_for_user(ctx, conn, user_id):
     return found_fsa
 
 
+def parse_fsas_to_ping(raw_fsas, fsa_index):
+    """
+    Validates and parses FSAs for a ping
+    :param raw_fsas:
+    :param fsa_index: FsaCentroidIndex, or None if neighbour lookups aren't available
+    :return: Unique, parsed FSAs
+    """
+    if len(raw_fsas) < 1:
+        raise ValueError("Please provide an area code (ex: K1P).")
+    fsas = parse_fsas_with_radius(raw_fsas, fsa_index)
+
+    if len(fsas) > MAX_FSAS_TO_PING_AT_ONCE:
+        raise ValueError("Sorry, you're trying to ping too many area codes at once.")
+
+    return fsas
+
+
+def render_ping_messages(fsas, conn):
+    """
+    Resolves the users registered to the given FSAs and renders the messages that ping them
+    :param fsas:
+    :param conn:
+    :return: Messages to send, each within discord's message length limit
+    """
+    messages = []
+    message_prefix = "New info for {} is here! Check the pins! ".format(" ".join(sorted([fsa.upper() for fsa in fsas])))
+    message = message_prefix
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT DISTINCT user_id FROM ping_reg WHERE fsa IN %(fsas)s", {"fsas": tuple(fsas)})
+            for row in cur:
+                message += "<@{}> ".format(row["user_id"])
+                if len(message) > DISCORD_MESSAGE_LENGTH_HIGH_WATERMARK:
+                    # Start a new message before we reach discord's message length limit
+                    messages.append(message)
+                    message = message_prefix
+    # Add any remaining users
+    if len(message) > len(message_prefix):
+        messages.append(message)
+
+    return messages
+
+
+def get_registrations_version(fsas, conn):
+    """
+    Gets a cheap fingerprint of the registrations for the given FSAs
+    NOTE: Inserts always increase the max ID and deletes always decrease the count, so any change alters the fingerprint
+    :param fsas:
+    :param conn:
+    :return: Fingerprint that changes whenever the registrations change
+    """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS count, MAX(id) AS max_id FROM ping_reg WHERE fsa IN %(fsas)s", {"fsas": tuple(fsas)})
+            result = cur.fetchone()
+
+    return result["count"], result["max_id"]
+
+
+def claim_scheduled_ping(schedule_id, conn):
+    """
+    Removes the given scheduled ping so it's only handled once
+    :param schedule_id:
+    :param conn:
+    :return: Whether the ping was claimed (False if it was unscheduled in the meantime)
+    """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM ping_schedule WHERE id=%(id)s", {"id": schedule_id})
+            return cur.rowcount > 0
+
+
+async def run_scheduled_ping(bot, conn, schedule):
+    """
+    Prepares the given scheduled ping's messages, keeps them up to date, and sends them once the ping is due
+    :param bot:
+    :param conn:
+    :param schedule: Row from ping_schedule
+    """
+    channel = bot.get_channel(int(schedule["channel_id"]))
+
+    if schedule["send_at"] < datetime.datetime.now() - SCHEDULE_MAX_LATENESS:
+        # Too late for the news to be new, so don't ping anyone
+        if not claim_scheduled_ping(schedule["id"], conn):
+            return
+        logger.warning("Dropped scheduled ping {} since it's overdue.".format(schedule["id"]))
+        if channel is not None:
+            await channel.send("<@{}> Scheduled ping {} was missed (due {}), so it wasn't sent.".format(
+                schedule["created_by"], schedule["id"], schedule["send_at"].strftime("%Y-%m-%d %H:%M")))
+        return
+
+    fsas = schedule["fsas"].split()
+    messages = render_ping_messages(fsas, conn)
+    version = get_registrations_version(fsas, conn)
+
+    while True:
+        time_left = (schedule["send_at"] - datetime.datetime.now()).total_seconds()
+        if time_left <= SCHEDULE_POLL_INTERVAL:
+            await asyncio.sleep(max(time_left, 0))
+            break
+
+        await asyncio.sleep(SCHEDULE_POLL_INTERVAL)
+
+        # Re-render only if registrations changed in the meantime
+        new_version = get_registrations_version(fsas, conn)
+        if new_version != version:
+            messages = render_ping_messages(fsas, conn)
+            version = new_version
+
+    # Catch any registration changes since the last check
+    if get_registrations_version(fsas, conn) != version:
+        messages = render_ping_messages(fsas, conn)
+
+    if not claim_scheduled_ping(schedule["id"], conn):
+        return
+
+    if channel is None:
+        logger.warning("Channel with ID {} not found for scheduled ping {}.".format(schedule["channel_id"], schedule["id"]))
+        return
+
+    if len(messages) == 0:
+        await channel.send("<@{}> No one to ping for scheduled ping {}.".format(schedule["created_by"], schedule["id"]))
+        return
+
+    # Messages are already rendered, so fire them all at once
+    results = await asyncio.gather(*[channel.send(message) for message in messages], return_exceptions=True)
+
+    failed_message_nums = []
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error("Failed to send message {} of scheduled ping {}: {}".format(i + 1, schedule["id"], result))
+            failed_message_nums.append(str(i + 1))
+    if len(failed_message_nums) > 0:
+        await channel.send("<@{}> Scheduled ping {} failed to send message(s) {} of {}.".format(
+            schedule["created_by"], schedule["id"], ", ".join(failed_message_nums), len(messages)))
+
+
 async def check_if_users_exist(guild: discord.guild.Guild, user_ids, missing_user_ids):
     found_users = await guild.query_members(user_ids=user_ids, limit=MAX_USERS_TO_QUERY_AT_ONCE, cache=False)
     new_missing_ids = set(user_ids).difference([u.id for u in found_users])
@@ -128,6 +274,17 @@ def main(argv):
     user_command_channel_name = config["user_command_channel"]
     delete_missing_users_interval = config["delete_missing_users_interval"]
     responses = config["responses"]
+    fsa_index = None
+    if config.get("fsa_centroids_path"):
+        fsa_index = FsaCentroidIndex.load(pathlib.Path(config["fsa_centroids_path"]).resolve())
+
+    # Only advertise nearby areas if they're available
+    if fsa_index is not None:
+        radius_help = " and optionally those nearby (ex: K1P +5km)."
+        radius_usage = "area1 area2 ... [+distance]"
+    else:
+        radius_help = " (ex: K1P)."
+        radius_usage = "area1 area2 ..."
 
     # Need the members intent to get users by username
     intents = discord.Intents.default()
@@ -164,20 +321,20 @@ def main(argv):
 
         await bot.process_commands(message)
 
-    @bot.command(name="add", help="Add me to pings for the given area (ex: K1P).", usage="area1 area2 ...")
+    @bot.command(name="add", help="Add me to pings for the given area" + radius_help, usage=radius_usage)
     async def ppadd(ctx, *raw_fsas):
         try:
-            add_user_to_fsas(ctx.author, raw_fsas, conn)
+            add_user_to_fsas(ctx.author, raw_fsas, conn, fsa_index)
         except ValueError as ex:
             await ctx.channel.send("{} {}".format(ctx.author.mention, str(ex)))
             return
 
         await ctx.channel.send("{} You've been added to those areas!".format(ctx.author.mention))
 
-    @bot.command(name="del", help="Delete me from pings for the given area (ex: K1P).", usage="area1 area2 ...")
+    @bot.command(name="del", help="Delete me from pings for the given area" + radius_help, usage=radius_usage)
     async def ppdel(ctx, *raw_fsas):
         try:
-            del_user_from_fsas(ctx.author.id, raw_fsas, conn)
+            del_user_from_fsas(ctx.author.id, raw_fsas, conn, fsa_index)
         except ValueError as ex:
             await ctx.channel.send("{} {}".format(ctx.author.mention, str(ex)))
             return
@@ -207,7 +364,7 @@ def main(argv):
             # Validate username
             user = parse_username(raw_username, ctx.author.guild)
 
-            add_user_to_fsas(user, raw_fsas, conn)
+            add_user_to_fsas(user, raw_fsas, conn, fsa_index)
         except ValueError as ex:
             await ctx.channel.send("{} {}".format(ctx.author.mention, str(ex)))
             return
@@ -221,7 +378,7 @@ def main(argv):
             # Validate username
             user = parse_username(raw_username, ctx.author.guild)
 
-            del_user_from_fsas(user.id, raw_fsas, conn)
+            del_user_from_fsas(user.id, raw_fsas, conn, fsa_index)
         except ValueError as ex:
             await ctx.channel.send("{} {}".format(ctx.author.mention, str(ex)))
             return
@@ -256,41 +413,79 @@ def main(argv):
         if not found_fsa:
             await ctx.channel.send("{} User not in list.".format(ctx.author.mention))
 
-    @bot.command(name="send", help="Ping the given area codes (ex: K1P).", usage="area1 area2 ...")
+    @bot.command(name="send", help="Ping the given area codes" + radius_help, usage=radius_usage)
     @commands.has_permissions(kick_members=True)
     async def ppsend(ctx, *raw_fsas):
-        if len(raw_fsas) < 1:
-            await ctx.channel.send("{} Please provide an area code (ex: K1P).".format(ctx.author.mention))
+        try:
+            fsas = parse_fsas_to_ping(raw_fsas, fsa_index)
+        except ValueError as ex:
+            await ctx.channel.send("{} {}".format(ctx.author.mention, str(ex)))
             return
+
+        messages = render_ping_messages(fsas, conn)
+        for message in messages:
+            await ctx.channel.send(message)
+
+        if len(messages) == 0:
+            await ctx.channel.send("{} No one to ping.".format(ctx.author.mention))
+
+    @bot.command(name="schedule", help="Ping the given area codes at the given time (ex: \"2021-04-20 16:30\" K1P).", usage="\"YYYY-MM-DD HH:MM\" area1 area2 ...")
+    @commands.has_permissions(kick_members=True)
+    async def ppschedule(ctx, raw_time, *raw_fsas):
         try:
-            fsas = parse_fsas(raw_fsas)
+            send_at = parse_schedule_time(raw_time)
+            fsas = parse_fsas_to_ping(raw_fsas, fsa_index)
         except ValueError as ex:
             await ctx.channel.send("{} {}".format(ctx.author.mention, str(ex)))
             return
 
-        if len(fsas) > MAX_FSAS_TO_PING_AT_ONCE:
-            await ctx.channel.send("{} Sorry, you're trying to ping too many area codes at once.".format(ctx.author.mention))
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO ping_schedule (fsas, channel_id, send_at, created_by) VALUES (%(fsas)s, %(channel_id)s, %(send_at)s, %(created_by)s) RETURNING id",
+                            {"fsas": " ".join(sorted(fsas)), "channel_id": str(ctx.channel.id), "send_at": send_at, "created_by": str(ctx.author.id)})
+                schedule_id = cur.fetchone()["id"]
+
+        await ctx.channel.send("{} Ping {} scheduled for {}.".format(ctx.author.mention, schedule_id, send_at.strftime("%Y-%m-%d %H:%M")))
+
+    @bot.command(name="unschedule", help="Cancel the given scheduled ping (ex: 12).", usage="ping_id")
+    @commands.has_permissions(kick_members=True)
+    async def ppunschedule(ctx, raw_schedule_id):
+        if not re.fullmatch("[0-9]+", raw_schedule_id):
+            await ctx.channel.send("{} Invalid ping ID. It should look like '12' (no quotes).".format(ctx.author.mention))
+            return
+
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM ping_schedule WHERE id=%(id)s", {"id": int(raw_schedule_id)})
+                deleted = cur.rowcount > 0
+
+        if not deleted:
+            await ctx.channel.send("{} Scheduled ping not found.".format(ctx.author.mention))
             return
 
-        message_prefix = "New info for {} is here! Check the pins! ".format(" ".join(sorted([fsa.upper() for fsa in fsas])))
-        message = message_prefix
-        found_users_to_ping = False
+        await ctx.channel.send("{} Scheduled ping cancelled.".format(ctx.author.mention))
+
+    @bot.command(name="schedules", help="List pending scheduled pings.")
+    @commands.has_permissions(kick_members=True)
+    async def ppschedules(ctx):
         with conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT DISTINCT user_id FROM ping_reg WHERE fsa IN %(fsas)s", {"fsas": tuple(fsas)})
-                for row in cur:
-                    found_users_to_ping = True
-                    message += "<@{}> ".format(row["user_id"])
-                    if len(message) > DISCORD_MESSAGE_LENGTH_HIGH_WATERMARK:
-                        # Flush the buffer before we reach discord's message length limit
-                        await ctx.channel.send(message)
-                        message = message_prefix
-        # Ping any remaining users
-        if len(message) > len(message_prefix):
-            await ctx.channel.send(message)
+                cur.execute("SELECT id, send_at, fsas FROM ping_schedule ORDER BY send_at")
+                rows = cur.fetchall()
 
-        if not found_users_to_ping:
-            await ctx.channel.send("{} No one to ping.".format(ctx.author.mention))
+        if len(rows) == 0:
+            await ctx.channel.send("{} No pings scheduled.".format(ctx.author.mention))
+            return
+
+        message = ctx.author.mention
+        for row in rows:
+            message += "\n{}: {} {}".format(row["id"], row["send_at"].strftime("%Y-%m-%d %H:%M"), row["fsas"].upper())
+            if len(message) > DISCORD_MESSAGE_LENGTH_HIGH_WATERMARK:
+                # Flush the buffer before we reach discord's message length limit
+                await ctx.channel.send(message)
+                message = ctx.author.mention
+        if len(message) > len(ctx.author.mention):
+            await ctx.channel.send(message)
 
     @bot.command(name="modhelp", help="Show this message.")
     @commands.has_permissions(kick_members=True)
@@ -360,7 +555,41 @@ def main(argv):
         except Exception:
             logger.exception("Exception during remove_missing_users.")
 
+    # IDs of scheduled pings that are currently being prepared or sent
+    scheduled_ping_ids = set()
+
+    async def send_scheduled_ping(schedule):
+        try:
+            await run_scheduled_ping(bot, conn, schedule)
+        except Exception:
+            logger.exception("Exception during scheduled ping {}.".format(schedule["id"]))
+        finally:
+            scheduled_ping_ids.discard(schedule["id"])
+
+    @tasks.loop(seconds=SCHEDULE_POLL_INTERVAL)
+    async def prepare_scheduled_pings():
+        if not bot.is_ready():
+            # Wait until the bot is connected
+            return
+
+        try:
+            # NOTE: Pings that came due while the bot was down are picked up here too and sent right away, or dropped if they're too late
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT * FROM ping_schedule WHERE send_at <= %(prepare_before)s",
+                                {"prepare_before": datetime.datetime.now() + SCHEDULE_PREPARE_LEAD_TIME})
+                    schedules = cur.fetchall()
+
+            for schedule in schedules:
+                if schedule["id"] in scheduled_ping_ids:
+                    continue
+                scheduled_ping_ids.add(schedule["id"])
+                bot.loop.create_task(send_scheduled_ping(schedule))
+        except Exception:
+            logger.exception("Exception during prepare_scheduled_pings.")
+
     remove_missing_users.start()
+    prepare_scheduled_pings.start()
     bot.run(config["discord_token"])
 
 
@@ -0,0 +1,66 @@
+import csv
+import numpy as np
+
+# Constants
+EARTH_RADIUS_KM = 6371.0
+
+
+class FsaCentroidIndex:
+    """
+    Index of FSA centroids for finding the FSAs near a given FSA
+    """
+
+    def __init__(self, fsas, latitudes, longitudes):
+        """
+        :param fsas: Parsed FSAs
+        :param latitudes: Latitude of each FSA's centroid, in degrees
+        :param longitudes: Longitude of each FSA's centroid, in degrees
+        """
+        self.fsas = np.array(fsas)
+        self.latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+        self.longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+        self.fsa_ixs = {fsa: ix for ix, fsa in enumerate(fsas)}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads the index from a CSV file of the form:
+        fsa | latitude | longitude
+        :param path:
+        :return: Loaded index
+        """
+        fsas = []
+        latitudes = []
+        longitudes = []
+        with open(path) as f:
+            r = csv.DictReader(f, delimiter=',', quotechar='"')
+            for row in r:
+                fsas.append(row["fsa"].lower())
+                latitudes.append(float(row["latitude"]))
+                longitudes.append(float(row["longitude"]))
+
+        return cls(fsas, latitudes, longitudes)
+
+    def find_within(self, fsas, radius_km):
+        """
+        Finds all FSAs whose centroids are within the given radius of any of the given FSAs' centroids
+        :param fsas: Parsed FSAs
+        :param radius_km:
+        :return: Unique FSAs within the radius, including the given FSAs
+        """
+        center_ixs = []
+        for fsa in fsas:
+            if fsa not in self.fsa_ixs:
+                raise ValueError("One of the given area codes has no known location.")
+            center_ixs.append(self.fsa_ixs[fsa])
+        center_latitudes = self.latitudes[center_ixs][:, np.newaxis]
+        center_longitudes = self.longitudes[center_ixs][:, np.newaxis]
+
+        # Haversine distance from every center to every FSA at once
+        a = np.sin((self.latitudes - center_latitudes) / 2) ** 2 \
+            + np.cos(center_latitudes) * np.cos(self.latitudes) * np.sin((self.longitudes - center_longitudes) / 2) ** 2
+        distances_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+        within_radius = np.any(distances_km <= radius_km, axis=0)
+
+        return self.fsas[within_radius].tolist()
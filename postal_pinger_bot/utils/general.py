@@ -1,9 +1,12 @@
+import datetime
 import psycopg2
 from psycopg2 import extras
 import re
 
 # Constants
 MAX_FSAS_TO_PROCESS_AT_ONCE = 999
+SCHEDULE_TIME_FORMAT = "%Y-%m-%d %H:%M"
+MAX_FSA_RADIUS_KM = 50
 
 
 def db_init(db_config):
@@ -32,6 +35,17 @@ def db_init(db_config):
             ]
             cur.execute("CREATE TABLE IF NOT EXISTS ping_missing_reg({})".format(", ".join(fields)))
 
+            # Create ping_schedule table
+            fields = [
+                "fsas TEXT NOT NULL",
+                "channel_id TEXT NOT NULL",
+                "send_at TIMESTAMP(0) NOT NULL",
+                "created_by TEXT NOT NULL",
+                "created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP",
+                "id BIGSERIAL"
+            ]
+            cur.execute("CREATE TABLE IF NOT EXISTS ping_schedule({})".format(", ".join(fields)))
+
     return conn
 
 
@@ -85,6 +99,60 @@ def parse_fsas(raw_fsas):
     return unique_fsas
 
 
+def parse_fsas_with_radius(raw_fsas, fsa_index):
+    """
+    Validates and parses FSAs from the given list, expanding them to their neighbours if a radius (ex: +5km) is given
+    :param raw_fsas:
+    :param fsa_index: FsaCentroidIndex, or None if neighbour lookups aren't available
+    :return: Unique, parsed FSAs
+    """
+    radii_km = []
+    remaining_raw_fsas = []
+    for raw_fsa in raw_fsas:
+        match = re.fullmatch(r"\+([0-9]{1,3}(?:\.[0-9]+)?)km", raw_fsa.lower())
+        if match:
+            radii_km.append(float(match.group(1)))
+        else:
+            remaining_raw_fsas.append(raw_fsa)
+
+    fsas = parse_fsas(remaining_raw_fsas)
+    if len(radii_km) == 0:
+        return fsas
+
+    # Validate radius
+    if len(radii_km) > 1:
+        raise ValueError("Please provide only one distance (ex: +5km).")
+    radius_km = radii_km[0]
+    if radius_km > MAX_FSA_RADIUS_KM:
+        raise ValueError("That distance is too large. It should be at most {}km.".format(MAX_FSA_RADIUS_KM))
+    if fsa_index is None:
+        raise ValueError("Sorry, nearby areas aren't available.")
+
+    fsas = fsa_index.find_within(fsas, radius_km)
+
+    if len(fsas) > MAX_FSAS_TO_PROCESS_AT_ONCE:
+        raise ValueError("That's too many codes at once.")
+
+    return fsas
+
+
+def parse_schedule_time(raw_time):
+    """
+    Validates and parses the given time of the form 'YYYY-MM-DD HH:MM' (bot's local time)
+    :param raw_time:
+    :return: Parsed time
+    """
+    try:
+        send_at = datetime.datetime.strptime(raw_time, SCHEDULE_TIME_FORMAT)
+    except ValueError:
+        raise ValueError("Invalid time. It should look like '2021-04-20 16:30' (with quotes).")
+
+    if send_at <= datetime.datetime.now():
+        raise ValueError("That time has already passed.")
+
+    return send_at
+
+
 def parse_username(raw_username, guild):
     """
     Validates and parses the given username of the form 'user1#1001'